@@ -9,6 +9,9 @@ train_pipeline = [
 train_dataloader = dict(
     batch_size=4,
     num_workers=4,
+    persistent_workers=True,
+    pin_memory=True,
+    prefetch_factor=4,
     dataset=dict(
         type='HFDreamBoothDataset',
         dataset='diffusers/dog-example',
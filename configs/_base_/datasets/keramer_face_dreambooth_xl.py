@@ -11,6 +11,9 @@ train_pipeline = [
 train_dataloader = dict(
     batch_size=2,
     num_workers=4,
+    persistent_workers=True,
+    pin_memory=True,
+    prefetch_factor=4,
     dataset=dict(
         type='HFDreamBoothDataset',
         dataset='diffusers/keramer-face-example',
@@ -29,6 +32,7 @@ custom_hooks = [
     dict(
         type='VisualizationHook',
         prompt=['a photo of sks person in suits'] * 4,
+        batch_size=1,
         by_epoch=False,
         interval=100),
     dict(type='LoRASaveHook'),
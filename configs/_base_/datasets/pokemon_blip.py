@@ -4,15 +4,20 @@ train_pipeline = [
     dict(type='torchvision/RandomHorizontalFlip', p=0.5),
     dict(type='torchvision/ToTensor'),
     dict(type='torchvision/Normalize', mean=[0.5], std=[0.5]),
-    dict(type='PackInputs'),
+    dict(type='PackInputs', input_keys=['img', 'input_ids']),
 ]
 train_dataloader = dict(
     batch_size=4,
     num_workers=4,
+    persistent_workers=True,
+    pin_memory=True,
+    prefetch_factor=4,
     dataset=dict(
         type='HFDataset',
         dataset='lambdalabs/pokemon-blip-captions',
-        pipeline=train_pipeline),
+        pipeline=train_pipeline,
+        # override together with `model.model`
+        pretokenize=[dict(model='runwayml/stable-diffusion-v1-5')]),
     sampler=dict(type='DefaultSampler', shuffle=True),
 )
 
@@ -1,20 +1,44 @@
+import os
+
+# resize and crop uint8 tensors, which is much faster than on PIL images,
+# and convert to float only after the image is cropped
 train_pipeline = [
     dict(type='SaveImageShape'),
-    dict(type='torchvision/Resize', size=1024, interpolation='bilinear'),
+    dict(type='torchvision/PILToTensor'),
+    dict(
+        type='torchvision/Resize',
+        size=1024,
+        interpolation='bilinear',
+        antialias=True),
     dict(type='RandomCropWithCropPoint', size=1024),
     dict(type='RandomHorizontalFlipFixCropPoint', p=0.5),
     dict(type='ComputeTimeIds'),
-    dict(type='torchvision/ToTensor'),
+    dict(type='torchvision/ConvertImageDtype', dtype='float32'),
     dict(type='torchvision/Normalize', mean=[0.5], std=[0.5]),
-    dict(type='PackInputs', input_keys=['img', 'text', 'time_ids']),
+    dict(
+        type='PackInputs',
+        input_keys=['img', 'input_ids_one', 'input_ids_two', 'time_ids']),
 ]
 train_dataloader = dict(
     batch_size=2,
-    num_workers=2,
+    num_workers=min((os.cpu_count() or 2) // 2, 8) or 1,
+    persistent_workers=True,
+    pin_memory=True,
+    prefetch_factor=4,
     dataset=dict(
         type='HFDataset',
         dataset='lambdalabs/pokemon-blip-captions',
-        pipeline=train_pipeline),
+        pipeline=train_pipeline,
+        # override together with `model.model`
+        pretokenize=[
+            dict(
+                model='stabilityai/stable-diffusion-xl-base-1.0',
+                output_key='input_ids_one'),
+            dict(
+                model='stabilityai/stable-diffusion-xl-base-1.0',
+                subfolder='tokenizer_2',
+                output_key='input_ids_two'),
+        ]),
     sampler=dict(type='DefaultSampler', shuffle=True),
 )
 
@@ -24,6 +48,6 @@ test_dataloader = val_dataloader
 test_evaluator = val_evaluator
 
 custom_hooks = [
-    dict(type='VisualizationHook', prompt=['yoda pokemon'] * 4),
+    dict(type='VisualizationHook', prompt=['yoda pokemon'] * 4, batch_size=1),
     dict(type='SDCheckpointHook')
 ]
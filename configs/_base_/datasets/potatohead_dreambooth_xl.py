@@ -11,6 +11,9 @@ train_pipeline = [
 train_dataloader = dict(
     batch_size=2,
     num_workers=4,
+    persistent_workers=True,
+    pin_memory=True,
+    prefetch_factor=4,
     dataset=dict(
         type='HFDreamBoothDataset',
         dataset='diffusers/potato-head-example',
@@ -29,6 +32,7 @@ custom_hooks = [
     dict(
         type='VisualizationHook',
         prompt=['A photo of sks character in a bucket'] * 4,
+        batch_size=1,
         by_epoch=False,
         interval=100),
     dict(type='LoRASaveHook'),
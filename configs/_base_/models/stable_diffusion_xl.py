@@ -2,4 +2,5 @@ model = dict(
     type='StableDiffusionXL',
     model='stabilityai/stable-diffusion-xl-base-1.0',
     vae_model='madebyollin/sdxl-vae-fp16-fix',
+    mixed_precision='bfloat16',
     gradient_checkpointing=True)
@@ -0,0 +1,17 @@
+_base_ = [
+    '../_base_/models/stable_diffusion_v15.py',
+    '../_base_/datasets/pokemon_blip.py',
+    '../_base_/schedules/stable_diffusion_50e.py',
+    '../_base_/default_runtime.py'
+]
+
+train_pipeline = [
+    dict(
+        type='LoadPrecomputedLatent',
+        latent_dir='work_dirs/pokemon_blip_latents'),
+    dict(
+        type='PackInputs',
+        input_keys=['latent_mean', 'latent_logvar', 'input_ids']),
+]
+train_dataloader = dict(
+    dataset=dict(pipeline=train_pipeline, load_image=False))
@@ -6,6 +6,6 @@ _base_ = [
 ]
 
 custom_hooks = [
-    dict(type='VisualizationHook', prompt=['yoda pokemon'] * 4),
+    dict(type='VisualizationHook', prompt=['yoda pokemon'] * 4, batch_size=1),
     dict(type='LoRASaveHook'),
 ]
@@ -8,6 +8,7 @@ from datasets import load_dataset
 from mmengine.dataset.base_dataset import Compose
 from PIL import Image
 from torch.utils.data import Dataset
+from transformers import CLIPTokenizerFast
 
 from diffengine.registry import DATASETS
 
@@ -21,13 +22,28 @@ class HFDataset(Dataset):
         image_column (str): Image column name. Defaults to 'image'.
         caption_column (str): Caption column name. Defaults to 'text'.
         pipeline (Sequence): Processing pipeline. Defaults to an empty tuple.
+        pretokenize (Sequence[dict]): Tokenizers to run on the captions once
+            when the dataset is built. Each dict takes ``model``,
+            ``subfolder`` (defaults to 'tokenizer') and ``output_key``
+            (defaults to 'input_ids'). The int32 token ids are stored in the
+            cached Arrow dataset and returned as ``output_key``, so neither
+            the training loop nor the dataloader workers tokenize text.
+            ``model`` must be the pretrained model that is trained, as
+            tokenizers of different models pad differently.
+            Defaults to an empty tuple.
+        load_image (bool): Whether to load the images. Set it to False when
+            the pipeline loads cached latents instead, so the image column is
+            never read or decoded and ``img`` is not returned.
+            Defaults to True.
     """
 
     def __init__(self,
                  dataset: str,
                  image_column: str = 'image',
                  caption_column: str = 'text',
-                 pipeline: Sequence = ()):
+                 pipeline: Sequence = (),
+                 pretokenize: Sequence[dict] = (),
+                 load_image: bool = True):
         self.dataset_name = dataset
         if Path(dataset).exists():
             # load local folder
@@ -40,6 +56,52 @@ class HFDataset(Dataset):
 
         self.image_column = image_column
         self.caption_column = caption_column
+        self.load_image = load_image
+        if not load_image:
+            # indexing a row decodes all of its columns
+            self.dataset = self.dataset.remove_columns(image_column)
+
+        self.token_keys = []
+        for cfg in pretokenize:
+            self.pretokenize(**cfg)
+
+    def pretokenize(self,
+                    model: str,
+                    subfolder: str = 'tokenizer',
+                    output_key: str = 'input_ids'):
+        """Tokenize the captions with ``CLIPTokenizerFast`` and store the
+        token ids in the dataset.
+
+        Every row stores one row of ids per caption, so rows with multiple
+        captions keep the ids of all of them.
+
+        Args:
+            model (str): pretrained model name of stable diffusion.
+            subfolder (str): Subfolder of the tokenizer.
+                Defaults to 'tokenizer'.
+            output_key (str): The column to save token ids.
+                Defaults to 'input_ids'.
+        """
+        tokenizer = CLIPTokenizerFast.from_pretrained(
+            model, subfolder=subfolder)
+
+        def tokenize(captions: list) -> dict:
+            input_ids = []
+            for caption in captions:
+                texts = [caption] if isinstance(caption, str) else caption
+                input_ids.append(
+                    tokenizer(
+                        list(texts),
+                        max_length=tokenizer.model_max_length,
+                        padding='max_length',
+                        truncation=True,
+                        return_tensors='np').input_ids.astype(np.int32))
+            return {output_key: input_ids}
+
+        # only the captions are passed, so images are not decoded
+        self.dataset = self.dataset.map(
+            tokenize, input_columns=self.caption_column, batched=True)
+        self.token_keys.append(output_key)
 
     def __len__(self) -> int:
         """Get the length of dataset.
@@ -61,21 +123,27 @@ class HFDataset(Dataset):
             ``self.train_transforms``.
         """
         data_info = self.dataset[idx]
-        image = data_info[self.image_column]
-        if type(image) == str:
-            image = Image.open(os.path.join(self.dataset_name, image))
-        image = image.convert('RGB')
         caption = data_info[self.caption_column]
+        caption_idx = 0
         if isinstance(caption, str):
             pass
         elif isinstance(caption, (list, np.ndarray)):
             # take a random caption if there are multiple
-            caption = random.choice(caption)
+            caption_idx = random.randrange(len(caption))
+            caption = caption[caption_idx]
         else:
             raise ValueError(
                 f'Caption column `{self.caption_column}` should contain either'
                 ' strings or lists of strings.')
-        result = dict(img=image, text=caption)
+        # idx keys the latents cached by tools/cache_latents.py
+        result = dict(text=caption, idx=idx)
+        if self.load_image:
+            image = data_info[self.image_column]
+            if type(image) == str:
+                image = Image.open(os.path.join(self.dataset_name, image))
+            result['img'] = image.convert('RGB')
+        for k in self.token_keys:
+            result[k] = np.asarray(data_info[k][caption_idx], dtype=np.int32)
         result = self.pipeline(result)
 
         return result
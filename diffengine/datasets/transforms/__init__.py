@@ -1,11 +1,13 @@
 from .base import BaseTransform
 from .formatting import PackInputs
 from .processing import (TRANSFORMS, CenterCropWithCropPoint, ComputeTimeIds,
-                         RandomCropWithCropPoint,
-                         RandomHorizontalFlipFixCropPoint, SaveImageShape)
+                         LoadPrecomputedLatent, RandomCropWithCropPoint,
+                         RandomHorizontalFlipFixCropPoint, SaveImageShape,
+                         TokenizeCLIP)
 
 __all__ = [
     'BaseTransform', 'PackInputs', 'TRANSFORMS', 'SaveImageShape',
     'RandomCropWithCropPoint', 'CenterCropWithCropPoint',
-    'RandomHorizontalFlipFixCropPoint', 'ComputeTimeIds'
+    'RandomHorizontalFlipFixCropPoint', 'ComputeTimeIds', 'TokenizeCLIP',
+    'LoadPrecomputedLatent'
 ]
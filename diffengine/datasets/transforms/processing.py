@@ -1,12 +1,16 @@
 import inspect
+import os.path as osp
 import random
 import re
 from enum import EnumMeta
 from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
+import torch
 import torchvision
-from torchvision.transforms.functional import crop
+from torchvision.transforms.functional import crop, get_dimensions
 from torchvision.transforms.transforms import InterpolationMode
+from transformers import CLIPTokenizerFast
 
 from diffengine.datasets.transforms.base import BaseTransform
 from diffengine.registry import TRANSFORMS
@@ -92,9 +96,9 @@ class SaveImageShape(BaseTransform):
         Returns:
             dict: 'ori_img_shape' key is added as original image shape.
         """
-        results['ori_img_shape'] = [
-            results['img'].height, results['img'].width
-        ]
+        # works for both PIL images and tensors
+        _, height, width = get_dimensions(results['img'])
+        results['ori_img_shape'] = [height, width]
         return results
 
 
@@ -142,10 +146,11 @@ class CenterCropWithCropPoint(BaseTransform):
         Returns:
             dict: 'crop_top_left' key is added as crop points.
         """
-        y1 = max(0, int(round((results['img'].height - self.size) / 2.0)))
-        x1 = max(0, int(round((results['img'].width - self.size) / 2.0)))
-        y2 = max(0, int(round((results['img'].height + self.size) / 2.0)))
-        x2 = max(0, int(round((results['img'].width + self.size) / 2.0)))
+        _, height, width = get_dimensions(results['img'])
+        y1 = max(0, int(round((height - self.size) / 2.0)))
+        x1 = max(0, int(round((width - self.size) / 2.0)))
+        y2 = max(0, int(round((height + self.size) / 2.0)))
+        x2 = max(0, int(round((width + self.size) / 2.0)))
         results['img'] = self.pipeline(results['img'])
         results['crop_top_left'] = [y1, x1]
         results['crop_bottom_right'] = [y2, x2]
@@ -174,7 +179,8 @@ class RandomHorizontalFlipFixCropPoint(BaseTransform):
             results['img'] = self.pipeline(results['img'])
             if 'crop_top_left' in results:
                 y1 = results['crop_top_left'][0]
-                x1 = results['img'].width - results['crop_bottom_right'][1]
+                _, _, width = get_dimensions(results['img'])
+                x1 = width - results['crop_bottom_right'][1]
                 results['crop_top_left'] = [y1, x1]
         return results
 
@@ -194,8 +200,78 @@ class ComputeTimeIds(BaseTransform):
         """
         assert 'ori_img_shape' in results
         assert 'crop_top_left' in results
-        target_size = [results['img'].height, results['img'].width]
+        _, height, width = get_dimensions(results['img'])
+        target_size = [height, width]
         time_ids = results['ori_img_shape'] + results[
             'crop_top_left'] + target_size
         results['time_ids'] = time_ids
         return results
+
+
+@TRANSFORMS.register_module()
+class TokenizeCLIP(BaseTransform):
+    """Tokenize 'text' and save the token ids as 'input_ids' in results.
+
+    Tokenizing in the data pipeline moves the work off the training loop
+    into the dataloader workers. The Rust based ``CLIPTokenizerFast`` is
+    used, which gives the same ids as the python ``CLIPTokenizer``.
+
+    Args:
+        model (str): pretrained model name of stable diffusion.
+        subfolder (str): Subfolder of the tokenizer. Defaults to 'tokenizer'.
+        output_key (str): The key to save token ids. Defaults to 'input_ids'.
+    """
+
+    def __init__(self,
+                 model: str,
+                 subfolder: str = 'tokenizer',
+                 output_key: str = 'input_ids'):
+        self.tokenizer = CLIPTokenizerFast.from_pretrained(
+            model, subfolder=subfolder)
+        self.output_key = output_key
+
+    def transform(self,
+                  results: Dict) -> Optional[Union[Dict, Tuple[List, List]]]:
+        """
+        Args:
+            results (dict): The result dict.
+
+        Returns:
+            dict: `output_key` key is added as token ids of 'text'.
+        """
+        results[self.output_key] = self.tokenizer(
+            results['text'],
+            max_length=self.tokenizer.model_max_length,
+            padding='max_length',
+            truncation=True,
+            return_tensors='pt').input_ids[0]
+        return results
+
+
+@TRANSFORMS.register_module()
+class LoadPrecomputedLatent(BaseTransform):
+    """Load the VAE latent distribution cached by ``tools/cache_latents.py``
+    and save it as 'latent_mean' and 'latent_logvar' in results.
+
+    Args:
+        latent_dir (str): Directory of the cached latents.
+    """
+
+    def __init__(self, latent_dir: str):
+        self.latent_dir = latent_dir
+
+    def transform(self,
+                  results: Dict) -> Optional[Union[Dict, Tuple[List, List]]]:
+        """
+        Args:
+            results (dict): The result dict.
+
+        Returns:
+            dict: 'latent_mean' and 'latent_logvar' keys are added.
+        """
+        assert 'idx' in results
+        parameters = torch.from_numpy(
+            np.load(osp.join(self.latent_dir, f'{results["idx"]}.npy')))
+        results['latent_mean'], results['latent_logvar'] = torch.chunk(
+            parameters, 2, dim=0)
+        return results
@@ -17,16 +17,21 @@ class VisualizationHook(Hook):
         interval (int): Visualization interval (every k iterations).
             Defaults to 1.
         by_epoch (bool): Whether to visualize by epoch. Defaults to True.
+        batch_size (int, optional): The number of prompts generated by one
+            pipeline call. If None, all prompts are generated at once.
+            Defaults to None.
     """
     priority = 'NORMAL'
 
     def __init__(self,
                  prompt: List[str],
                  interval: int = 1,
-                 by_epoch: bool = True):
+                 by_epoch: bool = True,
+                 batch_size: Optional[int] = None):
         self.prompt = prompt
         self.interval = interval
         self.by_epoch = by_epoch
+        self.batch_size = batch_size
 
     def after_train_iter(self,
                          runner,
@@ -44,7 +49,7 @@ class VisualizationHook(Hook):
             model = runner.model
             if is_model_wrapper(model):
                 model = model.module
-            images = model.infer(self.prompt)
+            images = model.infer(self.prompt, batch_size=self.batch_size)
             for i, image in enumerate(images):
                 runner.visualizer.add_image(
                     f'image{i}_step', image, step=runner.iter)
@@ -58,7 +63,7 @@ class VisualizationHook(Hook):
             model = runner.model
             if is_model_wrapper(model):
                 model = model.module
-            images = model.infer(self.prompt)
+            images = model.infer(self.prompt, batch_size=self.batch_size)
             for i, image in enumerate(images):
                 runner.visualizer.add_image(
                     f'image{i}_step', image, step=runner.epoch)
@@ -1,8 +1,14 @@
+from .fused_diffuse import fused_diffuse
 from .lora import (set_text_encoder_lora, set_unet_lora,
                    unet_attn_processors_state_dict)
+from .offload import CPUOffloader
+from .quantize import replace_linear_with_int8
 
 __all__ = [
     'set_unet_lora',
     'set_text_encoder_lora',
     'unet_attn_processors_state_dict',
+    'replace_linear_with_int8',
+    'CPUOffloader',
+    'fused_diffuse',
 ]
@@ -0,0 +1,116 @@
+from typing import Optional, Tuple
+
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+if triton is not None:
+
+    @triton.jit
+    def _fused_diffuse_kernel(latents_ptr, sqrt_alpha_prod_ptr,
+                              sqrt_one_minus_alpha_prod_ptr, noise_offset_ptr,
+                              noisy_latents_ptr, gt_ptr, n_elements,
+                              stride_batch, stride_channel, num_channels, seed,
+                              HAS_NOISE_OFFSET: tl.constexpr,
+                              V_PREDICTION: tl.constexpr,
+                              BLOCK_SIZE: tl.constexpr):
+        offsets = tl.program_id(0) * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
+        mask = offsets < n_elements
+        latents = tl.load(latents_ptr + offsets, mask=mask).to(tl.float32)
+        batch = offsets // stride_batch
+        sqrt_alpha_prod = tl.load(sqrt_alpha_prod_ptr + batch, mask=mask)
+        sqrt_one_minus_alpha_prod = tl.load(
+            sqrt_one_minus_alpha_prod_ptr + batch, mask=mask)
+
+        noise = tl.randn(seed, offsets)
+        if HAS_NOISE_OFFSET:
+            channel = (offsets // stride_channel) % num_channels
+            noise += tl.load(
+                noise_offset_ptr + batch * num_channels + channel, mask=mask)
+
+        noisy_latents = (
+            sqrt_alpha_prod * latents + sqrt_one_minus_alpha_prod * noise)
+        if V_PREDICTION:
+            gt = sqrt_alpha_prod * noise - sqrt_one_minus_alpha_prod * latents
+        else:
+            gt = noise
+        tl.store(
+            noisy_latents_ptr + offsets,
+            noisy_latents.to(noisy_latents_ptr.dtype.element_ty),
+            mask=mask)
+        tl.store(gt_ptr + offsets, gt.to(gt_ptr.dtype.element_ty), mask=mask)
+
+
+def fused_diffuse(latents: torch.Tensor,
+                  sqrt_alpha_prod: torch.Tensor,
+                  sqrt_one_minus_alpha_prod: torch.Tensor,
+                  noise_offset: Optional[torch.Tensor] = None,
+                  v_prediction: bool = False,
+                  block_size: int = 1024) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Sample the noise, add it to the latents and compute the target in one
+    Triton kernel.
+
+    The noise is generated in registers, so neither the noise nor the
+    intermediates of the noise offset and of the target are written to
+    memory. The kernel seed is drawn from the cpu generator of torch, so
+    ``set_random_seed`` keeps training reproducible without a device sync.
+
+    Args:
+        latents (torch.Tensor): The clean latents of shape (B, C, H, W) on a
+            CUDA device. Both contiguous and channels_last are supported.
+        sqrt_alpha_prod (torch.Tensor): Square root of ``alphas_cumprod`` at
+            the sampled timesteps, with B elements.
+        sqrt_one_minus_alpha_prod (torch.Tensor): Square root of
+            ``1 - alphas_cumprod`` at the sampled timesteps, with B elements.
+        noise_offset (torch.Tensor, optional): The weighted noise offset of
+            shape (B, C) added to the noise. Defaults to None.
+        v_prediction (bool): Whether the target is the velocity. Otherwise
+            the target is the noise. Defaults to False.
+        block_size (int): Number of elements processed by one program.
+            Defaults to 1024.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The noisy latents and the target,
+        with the same dtype and memory format as ``latents``.
+    """
+    if triton is None:
+        raise ImportError(
+            'Please run "pip install triton" to use the fused diffuse kernel.')
+    assert latents.is_cuda, 'The fused diffuse kernel requires CUDA tensors.'
+    if not (latents.is_contiguous()
+            or latents.is_contiguous(memory_format=torch.channels_last)):
+        latents = latents.contiguous()
+    num_batches, num_channels = latents.shape[:2]
+
+    noisy_latents = torch.empty_like(latents)
+    gt = torch.empty_like(latents)
+    sqrt_alpha_prod = sqrt_alpha_prod.reshape(num_batches).float()
+    sqrt_one_minus_alpha_prod = sqrt_one_minus_alpha_prod.reshape(
+        num_batches).float()
+    if noise_offset is not None:
+        noise_offset = noise_offset.reshape(num_batches,
+                                            num_channels).float().contiguous()
+    seed = int(torch.randint(2**31 - 1, (1, )).item())
+
+    n_elements = latents.numel()
+    grid = (triton.cdiv(n_elements, block_size), )
+    _fused_diffuse_kernel[grid](
+        latents,
+        sqrt_alpha_prod,
+        sqrt_one_minus_alpha_prod,
+        noise_offset if noise_offset is not None else sqrt_alpha_prod,
+        noisy_latents,
+        gt,
+        n_elements,
+        latents.stride(0),
+        latents.stride(1),
+        num_channels,
+        seed,
+        HAS_NOISE_OFFSET=noise_offset is not None,
+        V_PREDICTION=v_prediction,
+        BLOCK_SIZE=block_size)
+    return noisy_latents, gt
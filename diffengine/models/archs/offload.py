@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Union
+
+import torch
+from torch import nn
+
+
+class CPUOffloader:
+    """Keep the weights of a frozen module on cpu while it is not used.
+
+    The cpu copy of the weights is made once, in pinned memory when cuda is
+    available. Offloading only drops the device copy and onloading is an
+    asynchronous host to device copy. Buffers are small and stay on the
+    model device, so the module keeps working with DDP buffer broadcasting.
+
+    Args:
+        modules (nn.Module or List[nn.Module]): The frozen modules to
+            offload.
+        enabled (bool): Whether to offload. If False, :meth:`onload` does
+            nothing. Defaults to True.
+    """
+
+    def __init__(self,
+                 modules: Union[nn.Module, List[nn.Module]],
+                 enabled: bool = True):
+        if isinstance(modules, nn.Module):
+            modules = [modules]
+        self.modules = modules
+        self.enabled = enabled
+        self.cpu_weights: Optional[List[torch.Tensor]] = None
+
+    def parameters(self) -> Iterator[nn.Parameter]:
+        for module in self.modules:
+            yield from module.parameters()
+
+    def offload(self):
+        """Move the weights to cpu."""
+        if self.cpu_weights is None:
+            pin_memory = torch.cuda.is_available()
+            self.cpu_weights = [
+                p.data.cpu().pin_memory() if pin_memory else p.data.cpu()
+                for p in self.parameters()
+            ]
+        for p, cpu_weight in zip(self.parameters(), self.cpu_weights):
+            p.data = cpu_weight
+
+    @contextmanager
+    def onload(self, device: torch.device):
+        """Move the weights to ``device`` in the context and offload them
+        when leaving it."""
+        if not self.enabled:
+            yield
+            return
+        if self.cpu_weights is not None:
+            for p, cpu_weight in zip(self.parameters(), self.cpu_weights):
+                p.data = cpu_weight.to(device, non_blocking=True)
+        try:
+            yield
+        finally:
+            self.offload()
@@ -0,0 +1,39 @@
+from torch import nn
+
+
+def replace_linear_with_int8(module: nn.Module,
+                             threshold: float = 6.0) -> nn.Module:
+    """Replace ``nn.Linear`` layers of a frozen module with int8 layers.
+
+    The layers are replaced with ``Linear8bitLt`` of bitsandbytes. The weights
+    are quantized when the module is moved to a CUDA device, so the module
+    should be frozen and must not be trained afterwards.
+
+    Args:
+        module (nn.Module): The frozen module to quantize.
+        threshold (float): The outlier threshold of LLM.int8(). Input
+            features above it are computed in fp16. Defaults to 6.0.
+    """
+    try:
+        import bitsandbytes as bnb
+    except ImportError:
+        raise ImportError(
+            'Please run "pip install bitsandbytes" to quantize frozen models.')
+
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            int8_linear = bnb.nn.Linear8bitLt(
+                child.in_features,
+                child.out_features,
+                bias=child.bias is not None,
+                has_fp16_weights=False,
+                threshold=threshold)
+            int8_linear.weight = bnb.nn.Int8Params(
+                child.weight.data, requires_grad=False, has_fp16_weights=False)
+            if child.bias is not None:
+                int8_linear.bias = nn.Parameter(
+                    child.bias.data, requires_grad=False)
+            setattr(module, name, int8_linear)
+        else:
+            replace_linear_with_int8(child, threshold=threshold)
+    return module
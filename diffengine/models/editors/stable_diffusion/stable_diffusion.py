@@ -5,12 +5,16 @@ import numpy as np
 import torch
 from diffusers import (AutoencoderKL, DDPMScheduler, StableDiffusionPipeline,
                        UNet2DConditionModel)
+from diffusers.utils import is_xformers_available
 from mmengine import print_log
 from mmengine.model import BaseModel
 from torch import nn
-from transformers import CLIPTextModel, CLIPTokenizer
+from transformers import CLIPTextModel, CLIPTokenizer, PreTrainedTokenizer
 
-from diffengine.models.archs import set_text_encoder_lora, set_unet_lora
+from diffengine.models.archs import (CPUOffloader, fused_diffuse,
+                                     replace_linear_with_int8,
+                                     set_text_encoder_lora, set_unet_lora)
+from diffengine.models.losses.l2_loss import L2Loss, v_prediction_l2_loss
 from diffengine.models.losses.snr_l2_loss import SNRL2Loss
 from diffengine.registry import MODELS
 
@@ -36,6 +40,36 @@ class StableDiffusion(BaseModel):
         gradient_checkpointing (bool): Whether or not to use gradient
             checkpointing to save memory at the expense of slower backward
             pass. Defaults to False.
+        mixed_precision (str, optional): The dtype, 'float16' or 'bfloat16',
+            to cast the frozen vae and text encoder to. This halves their
+            memory and bandwidth. Pair it with an ``AmpOptimWrapper`` of the
+            same dtype, which autocasts the trained modules. Defaults to None.
+        compile_unet (bool or dict): Whether to compile the unet forward
+            with ``torch.compile``. It is used by both training and
+            :meth:`infer`. A dict is passed to ``torch.compile`` as keyword
+            arguments, ``True`` uses ``dict(mode='max-autotune',
+            dynamic=False)``. Defaults to False.
+        channels_last (bool): Whether to use the channels_last memory format
+            for the unet and vae so that cuDNN can pick NHWC kernels.
+            Defaults to False.
+        quantize_frozen (bool): Whether to quantize the linear layers of the
+            frozen text encoder to int8 with bitsandbytes. It is ignored when
+            the text encoder is fine-tuned. Requires a CUDA device.
+            Defaults to False.
+        tiny_vae_model (str, optional): Path to a pretrained
+            ``AutoencoderTiny``, e.g. 'madebyollin/taesd'. It replaces the vae
+            in :meth:`infer` to decode latents much faster at a small cost of
+            fidelity. Training always uses the full vae. Requires
+            diffusers>=0.20.0. Defaults to None.
+        cpu_offload (bool): Whether to keep the weights of the frozen vae and
+            text encoder on cpu and only move them to the device while they
+            are used. It frees device memory for the unet at the cost of a
+            host to device copy per use. Defaults to False.
+        fuse_diffuse (bool): Whether to sample the noise and compute the
+            noisy latents and the target in one Triton kernel on CUDA devices.
+            It saves the memory traffic of the noise tensors but uses another
+            random stream than ``torch.randn``. Requires triton.
+            Defaults to False.
         data_preprocessor (dict, optional): The pre-process config of
             :class:`BaseDataPreprocessor`.
     """
@@ -49,6 +83,13 @@ class StableDiffusion(BaseModel):
         prior_loss_weight: float = 1.,
         noise_offset_weight: float = 0,
         gradient_checkpointing: bool = False,
+        mixed_precision: Optional[str] = None,
+        compile_unet: Union[bool, dict] = False,
+        channels_last: bool = False,
+        quantize_frozen: bool = False,
+        tiny_vae_model: Optional[str] = None,
+        cpu_offload: bool = False,
+        fuse_diffuse: bool = False,
         data_preprocessor: Optional[Union[dict, nn.Module]] = dict(
             type='SDDataPreprocessor'),
     ):
@@ -64,26 +105,60 @@ class StableDiffusion(BaseModel):
 
         self.enable_noise_offset = noise_offset_weight > 0
         self.noise_offset_weight = noise_offset_weight
+        self.channels_last = channels_last
+        self.quantize_frozen = quantize_frozen
+        self.tiny_vae_model = tiny_vae_model
+        self.fuse_diffuse = fuse_diffuse
+        assert not (cpu_offload and quantize_frozen), \
+            'cpu_offload does not support quantized models.'
+
+        assert mixed_precision in (None, 'float16', 'bfloat16'), \
+            f'mixed_precision should be float16 or bfloat16, got ' \
+            f'{mixed_precision}'
+        self.weight_dtype = None if mixed_precision is None else getattr(
+            torch, mixed_precision)
 
         self.tokenizer = CLIPTokenizer.from_pretrained(
             model, subfolder='tokenizer')
         self.scheduler = DDPMScheduler.from_pretrained(
             model, subfolder='scheduler')
+        # keep the noise schedule on the model device to avoid indexing the
+        # cpu `alphas_cumprod` of the scheduler every step
+        alphas_cumprod = self.scheduler.alphas_cumprod.float()
+        self.register_buffer(
+            'sqrt_alphas_cumprod', alphas_cumprod.sqrt(), persistent=False)
+        self.register_buffer(
+            'sqrt_one_minus_alphas_cumprod', (1.0 - alphas_cumprod).sqrt(),
+            persistent=False)
 
         self.text_encoder = CLIPTextModel.from_pretrained(
             model, subfolder='text_encoder')
         self.vae = AutoencoderKL.from_pretrained(model, subfolder='vae')
         self.unet = UNet2DConditionModel.from_pretrained(
             model, subfolder='unet')
+        self._pipeline = None
+        # pre-tokenized ids are checked once, as the check syncs the device
+        self._input_ids_checked = False
         self.prepare_model()
+        if self.channels_last:
+            self.unet.to(memory_format=torch.channels_last)
+            self.vae.to(memory_format=torch.channels_last)
         if gradient_checkpointing:
             self.unet.enable_gradient_checkpointing()
             if self.finetune_text_encoder:
                 self.text_encoder.gradient_checkpointing_enable()
         self.set_lora()
+        self.set_compile(compile_unet)
+        self.vae_offloader = CPUOffloader(self.vae, enabled=cpu_offload)
+        # a fine-tuned text encoder needs its weights in backward
+        self.text_encoder_offloader = CPUOffloader(
+            self.text_encoder,
+            enabled=cpu_offload and not self.finetune_text_encoder)
 
     def set_lora(self):
         """Set LORA for model."""
+        # the cached pipeline must not outlive a change of attn processors
+        self._pipeline = None
         if self.lora_config is not None:
             if self.finetune_text_encoder:
                 self.text_encoder.requires_grad_(False)
@@ -91,6 +166,25 @@ class StableDiffusion(BaseModel):
             self.unet.requires_grad_(False)
             set_unet_lora(self.unet, self.lora_config)
 
+    def set_compile(self, compile_cfg: Union[bool, dict]):
+        """Compile the unet forward with ``torch.compile``.
+
+        Like ``compile`` of mmengine ``Runner``, the compiled function
+        replaces ``forward`` of the unet instance, so the module, its
+        ``state_dict`` and the pipeline built by :meth:`infer` are kept.
+
+        Args:
+            compile_cfg (bool or dict): ``torch.compile`` keyword arguments,
+                or whether to compile with the default arguments.
+        """
+        if isinstance(compile_cfg, bool):
+            if not compile_cfg:
+                return
+            compile_cfg = dict(mode='max-autotune', dynamic=False)
+        self.unet.forward = torch.compile(self.unet.forward, **compile_cfg)
+        print_log('Compiled UNet. The first few iterations will be slow.',
+                  'current')
+
     def prepare_model(self):
         """Prepare model for training.
 
@@ -102,15 +196,29 @@ class StableDiffusion(BaseModel):
             self.text_encoder.requires_grad_(False)
             print_log('Set Text Encoder untrainable.', 'current')
 
+        if self.weight_dtype is not None:
+            self.vae.to(self.weight_dtype)
+            if not self.finetune_text_encoder:
+                self.text_encoder.to(self.weight_dtype)
+            print_log(f'Cast frozen models to {self.weight_dtype}.', 'current')
+
+        if self.quantize_frozen and not self.finetune_text_encoder:
+            # the weights are quantized when moved to cuda, after the cast
+            # to `weight_dtype` above
+            replace_linear_with_int8(self.text_encoder)
+            print_log('Quantize Text Encoder to int8.', 'current')
+
     @property
     def device(self):
-        return next(self.parameters()).device
+        # frozen models may be offloaded to cpu
+        return next(self.unet.parameters()).device
 
     @torch.no_grad()
     def infer(self,
               prompt: List[str],
               height: Optional[int] = None,
-              width: Optional[int] = None) -> List[np.ndarray]:
+              width: Optional[int] = None,
+              batch_size: Optional[int] = None) -> List[np.ndarray]:
         """Function invoked when calling the pipeline for generation.
 
         Args:
@@ -122,28 +230,103 @@ class StableDiffusion(BaseModel):
             width (`int`, *optional*, defaults to
                 `self.unet.config.sample_size * self.vae_scale_factor`):
                 The width in pixels of the generated image.
+            batch_size (`int`, *optional*, defaults to `len(prompt)`):
+                The number of prompts generated by one pipeline call. Lower
+                it to bound the memory used for many prompts.
         """
-        pipeline = StableDiffusionPipeline.from_pretrained(
-            self.model,
-            vae=self.vae,
-            text_encoder=self.text_encoder,
-            tokenizer=self.tokenizer,
-            unet=self.unet,
-            safety_checker=None,
-            dtype=torch.float16)
-        pipeline.set_progress_bar_config(disable=True)
+        pipeline = self.build_pipeline()
+        # decode batched latents one image at a time and large images tile by
+        # tile to bound memory. The vae is shared with training and both
+        # options also apply to encoding, so they are switched off below.
+        pipeline.enable_vae_slicing()
+        pipeline.enable_vae_tiling()
+        # xFormers attention is only used for inference. The unet and the vae
+        # are shared with training, so their attention processors are saved
+        # and restored below. Swapping processors replaces LoRA layers with
+        # new modules that the optimizer does not track, so LoRA models keep
+        # their processors. On torch 2 the default processors already use
+        # `F.scaled_dot_product_attention`.
+        attn_processors = {}
+        if (self.lora_config is None and is_xformers_available()
+                and self.device.type == 'cuda'):
+            attn_processors = {
+                module: module.attn_processors
+                for module in (self.unet, self.vae)
+                if hasattr(module, 'attn_processors')
+            }
+            pipeline.enable_xformers_memory_efficient_attention()
+        batch_size = max(1, batch_size or len(prompt))
         images = []
-        for p in prompt:
-            image = pipeline(
-                p, num_inference_steps=50, height=height,
-                width=width).images[0]
-            images.append(np.array(image))
-
-        del pipeline
-        torch.cuda.empty_cache()
+        try:
+            # the pipeline mixes frozen models in `weight_dtype` with the unet
+            with torch.autocast(
+                    self.device.type,
+                    dtype=self.weight_dtype,
+                    enabled=self.weight_dtype is not None), \
+                    self.vae_offloader.onload(self.device), \
+                    self.text_encoder_offloader.onload(self.device):
+                for i in range(0, len(prompt), batch_size):
+                    outputs = pipeline(
+                        prompt[i:i + batch_size],
+                        num_inference_steps=50,
+                        height=height,
+                        width=width,
+                        output_type='pt').images
+                    # quantize on device as the PIL output does, then copy
+                    # the whole batch to cpu at once as contiguous HWC images
+                    outputs = outputs.mul(255).round().to(torch.uint8)
+                    images.extend(
+                        outputs.permute(0, 2, 3, 1).contiguous().cpu().numpy())
+        finally:
+            for module, processors in attn_processors.items():
+                module.set_attn_processor(processors)
+            pipeline.disable_vae_slicing()
+            pipeline.disable_vae_tiling()
 
         return images
 
+    def build_pipeline(self) -> StableDiffusionPipeline:
+        """Build the inference pipeline on first use and cache it.
+
+        The pipeline shares ``vae``, ``text_encoder``, ``tokenizer`` and
+        ``unet`` with this model, so the cached pipeline always sees the
+        latest trained weights.
+
+        Returns:
+            StableDiffusionPipeline: The cached pipeline.
+        """
+        if self._pipeline is None:
+            vae = self.vae
+            if self.tiny_vae_model is not None:
+                try:
+                    from diffusers import AutoencoderTiny
+                except ImportError:
+                    raise ImportError(
+                        'tiny_vae_model requires diffusers>=0.20.0.')
+                vae = AutoencoderTiny.from_pretrained(
+                    self.tiny_vae_model, torch_dtype=self.vae.dtype)
+            pipeline = StableDiffusionPipeline.from_pretrained(
+                self.model,
+                vae=vae,
+                text_encoder=self.text_encoder,
+                tokenizer=self.tokenizer,
+                unet=self.unet,
+                safety_checker=None,
+                requires_safety_checker=False)
+            pipeline.set_progress_bar_config(disable=True)
+            self._pipeline = pipeline
+        if self.tiny_vae_model is not None:
+            # the tiny vae is not a submodule, so it does not follow the
+            # model to its device
+            self._pipeline.vae.to(self.device)
+        return self._pipeline
+
+    def release_pipeline(self):
+        """Drop the cached inference pipeline and free cached GPU memory."""
+        self._pipeline = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     def val_step(self, data: Union[tuple, dict, list]) -> list:
         raise NotImplementedError(
             'val_step is not implemented now, please use infer.')
@@ -152,54 +335,129 @@ class StableDiffusion(BaseModel):
         raise NotImplementedError(
             'test_step is not implemented now, please use infer.')
 
+    def _check_input_ids(self, input_ids: torch.Tensor,
+                         tokenizer: PreTrainedTokenizer, key: str):
+        """Check that ids tokenized in the dataset are padded with the pad
+        token of ``tokenizer``.
+
+        The dataset tokenizer is configured apart from ``model``, and
+        tokenizers of different models may pad with different tokens, e.g.
+        stable diffusion v1.5 pads with the eos token and v2 with '!'.
+
+        Args:
+            input_ids (torch.Tensor): The pre-tokenized ids.
+            tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+            key (str): The input key of the ids.
+        """
+        is_eos = input_ids == tokenizer.eos_token_id
+        # the tokens after the first eos token are padding
+        is_pad = is_eos.cumsum(dim=1) - is_eos.long() > 0
+        if (input_ids[is_pad] != tokenizer.pad_token_id).any():
+            raise ValueError(
+                f'`{key}` is not padded by the tokenizer of {self.model}. '
+                'Set `pretokenize` of the dataset to the same model.')
+
     def forward(self,
                 inputs: torch.Tensor,
                 data_samples: Optional[list] = None,
                 mode: str = 'loss'):
         assert mode == 'loss'
-        inputs['text'] = self.tokenizer(
-            inputs['text'],
-            max_length=self.tokenizer.model_max_length,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt').input_ids.to(self.device)
-        num_batches = len(inputs['img'])
+        if 'input_ids' not in inputs:
+            inputs['input_ids'] = self.tokenizer(
+                inputs['text'],
+                max_length=self.tokenizer.model_max_length,
+                padding='max_length',
+                truncation=True,
+                return_tensors='pt').input_ids.to(
+                    self.device, non_blocking=True)
+        elif not self._input_ids_checked:
+            self._check_input_ids(inputs['input_ids'], self.tokenizer,
+                                  'input_ids')
+            self._input_ids_checked = True
+        if 'latent_mean' in inputs:
+            # sample from the latent distribution cached by
+            # tools/cache_latents.py instead of running the vae encoder
+            std = torch.exp(0.5 * inputs['latent_logvar'].clamp(-30.0, 20.0))
+            latents = inputs['latent_mean'] + std * torch.randn_like(std)
+        else:
+            img = inputs['img'].to(self.vae.dtype)
+            if self.channels_last:
+                img = img.contiguous(memory_format=torch.channels_last)
+            with self.vae_offloader.onload(self.device):
+                latents = self.vae.encode(img).latent_dist.sample()
+        # frozen models may run in `weight_dtype`, the unet gets its own dtype
+        latents = latents.to(self.unet.dtype) * self.vae.config.scaling_factor
+        if self.channels_last:
+            # noise and noisy latents inherit the memory format
+            latents = latents.contiguous(memory_format=torch.channels_last)
+
+        num_batches = latents.shape[0]
         if 'result_class_image' in inputs:
             # use prior_loss_weight
-            weight = torch.cat([
-                torch.ones((num_batches // 2, )),
-                torch.ones((num_batches // 2, )) * self.prior_loss_weight
-            ]).to(self.device).float().reshape(-1, 1, 1, 1)
+            weight = torch.ones(num_batches, device=self.device)
+            weight[num_batches // 2:] = self.prior_loss_weight
+            weight = weight.view(-1, 1, 1, 1)
         else:
             weight = None
 
-        latents = self.vae.encode(inputs['img']).latent_dist.sample()
-        latents = latents * self.vae.config.scaling_factor
-
-        noise = torch.randn_like(latents)
-
-        if self.enable_noise_offset:
-            noise = noise + self.noise_offset_weight * torch.randn(
-                latents.shape[0], latents.shape[1], 1, 1, device=noise.device)
-
-        num_batches = latents.shape[0]
         timesteps = torch.randint(
             0,
             self.scheduler.num_train_timesteps, (num_batches, ),
             device=self.device)
         timesteps = timesteps.long()
 
-        noisy_latents = self.scheduler.add_noise(latents, noise, timesteps)
+        sqrt_alpha_prod = self.sqrt_alphas_cumprod[timesteps].view(-1, 1, 1, 1)
+        sqrt_one_minus_alpha_prod = self.sqrt_one_minus_alphas_cumprod[
+            timesteps].view(-1, 1, 1, 1)
+        prediction_type = self.scheduler.config.prediction_type
+        if prediction_type not in ('epsilon', 'v_prediction'):
+            raise ValueError(f'Unknown prediction type {prediction_type}')
 
-        encoder_hidden_states = self.text_encoder(inputs['text'])[0]
-
-        if self.scheduler.config.prediction_type == 'epsilon':
-            gt = noise
-        elif self.scheduler.config.prediction_type == 'v_prediction':
-            gt = self.scheduler.get_velocity(latents, noise, timesteps)
+        if self.fuse_diffuse and latents.is_cuda:
+            noise_offset = None
+            if self.enable_noise_offset:
+                noise_offset = self.noise_offset_weight * torch.randn(
+                    latents.shape[:2], device=latents.device)
+            # the noise only lives in registers of the kernel
+            noisy_latents, gt = fused_diffuse(
+                latents,
+                sqrt_alpha_prod,
+                sqrt_one_minus_alpha_prod,
+                noise_offset=noise_offset,
+                v_prediction=prediction_type == 'v_prediction')
         else:
-            raise ValueError('Unknown prediction type '
-                             f'{self.scheduler.config.prediction_type}')
+            noise = torch.randn_like(latents)
+
+            if self.enable_noise_offset:
+                # broadcast the per-channel offset into `noise` in place
+                # instead of allocating another latents-sized tensor
+                noise.add_(
+                    torch.randn(
+                        latents.shape[0],
+                        latents.shape[1],
+                        1,
+                        1,
+                        device=noise.device,
+                        dtype=noise.dtype),
+                    alpha=self.noise_offset_weight)
+
+            noisy_latents = (
+                sqrt_alpha_prod * latents + sqrt_one_minus_alpha_prod * noise)
+            if prediction_type == 'epsilon':
+                gt = noise
+            elif type(self.loss_module) is L2Loss:
+                # the velocity is computed inside the fused loss. Subclasses
+                # may override forward, so they get the target instead.
+                gt = None
+            else:
+                gt = (
+                    sqrt_alpha_prod * noise -
+                    sqrt_one_minus_alpha_prod * latents)
+
+        with self.text_encoder_offloader.onload(self.device):
+            # ids pre-tokenized in the dataset are stored as int32
+            encoder_hidden_states = self.text_encoder(
+                inputs['input_ids'].long())[0].to(self.unet.dtype)
 
         model_pred = self.unet(
             noisy_latents,
@@ -208,7 +466,15 @@ class StableDiffusion(BaseModel):
 
         loss_dict = dict()
         # calculate loss in FP32
-        if isinstance(self.loss_module, SNRL2Loss):
+        if gt is None:
+            loss = v_prediction_l2_loss(
+                model_pred.float(),
+                latents.float(),
+                noise.float(),
+                sqrt_alpha_prod,
+                sqrt_one_minus_alpha_prod,
+                weight=weight) * self.loss_module.loss_weight
+        elif isinstance(self.loss_module, SNRL2Loss):
             loss = self.loss_module(
                 model_pred.float(),
                 gt.float(),
@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Optional, Union
 
 import torch
 from mmengine.model.base_model.data_preprocessor import BaseDataPreprocessor
@@ -8,6 +8,16 @@ from diffengine.registry import MODELS
 
 @MODELS.register_module()
 class SDXLDataPreprocessor(BaseDataPreprocessor):
+    """Data pre-processor for Stable Diffusion XL.
+
+    Args:
+        non_blocking (bool, optional): Whether to copy the data to the device
+            asynchronously. It overlaps the copy with compute when the
+            dataloader uses ``pin_memory=True``. Defaults to True.
+    """
+
+    def __init__(self, non_blocking: Optional[bool] = True):
+        super().__init__(non_blocking=non_blocking)
 
     def forward(self, data: dict, training: bool = False) -> Union[dict, list]:
         """Preprocesses the data into the model input format.
@@ -25,13 +35,17 @@ class SDXLDataPreprocessor(BaseDataPreprocessor):
         """
         if 'result_class_image' in data['inputs']:
             # dreambooth with class image
-            data['inputs']['text'] = data['inputs']['text'] + data['inputs'][
-                'result_class_image'].pop('text')
-            data['inputs']['img'] = data['inputs']['img'] + data['inputs'][
-                'result_class_image'].pop('img')
-            data['inputs']['time_ids'] = data['inputs']['time_ids'] + data[
-                'inputs']['result_class_image'].pop('time_ids')
+            class_inputs = data['inputs']['result_class_image']
+            for k in list(class_inputs):
+                data['inputs'][k] = data['inputs'][k] + class_inputs.pop(k)
+        # copy the pinned samples before stacking, `torch.stack` on cpu would
+        # return a pageable tensor and make the copy synchronous
+        data = self.cast_data(data)  # type: ignore
 
         data['inputs']['img'] = torch.stack(data['inputs']['img'])
         data['inputs']['time_ids'] = torch.stack(data['inputs']['time_ids'])
-        return super().forward(data)  # type: ignore
+        for k in ['input_ids_one', 'input_ids_two']:
+            if k in data['inputs']:
+                # text tokenized in the data pipeline
+                data['inputs'][k] = torch.stack(data['inputs'][k])
+        return data
@@ -1,4 +1,4 @@
-from .l2_loss import L2Loss
+from .l2_loss import L2Loss, v_prediction_l2_loss
 from .snr_l2_loss import SNRL2Loss
 
-__all__ = ['L2Loss', 'SNRL2Loss']
+__all__ = ['L2Loss', 'SNRL2Loss', 'v_prediction_l2_loss']
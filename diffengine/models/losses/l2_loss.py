@@ -7,6 +7,41 @@ import torch.nn.functional as F
 from diffengine.registry import MODELS
 
 
+@torch.jit.script
+def v_prediction_l2_loss(
+        pred: torch.Tensor,
+        latents: torch.Tensor,
+        noise: torch.Tensor,
+        sqrt_alpha_prod: torch.Tensor,
+        sqrt_one_minus_alpha_prod: torch.Tensor,
+        weight: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """L2 loss against the v-prediction target.
+
+    The velocity ``sqrt_alpha_prod * noise - sqrt_one_minus_alpha_prod *
+    latents`` is computed inside the scripted function, so the TorchScript
+    fuser can produce the target and the squared error in one kernel
+    instead of materializing the target tensor.
+
+    Args:
+        pred (torch.Tensor): The model prediction.
+        latents (torch.Tensor): The clean latents.
+        noise (torch.Tensor): The noise added to the latents.
+        sqrt_alpha_prod (torch.Tensor): Square root of ``alphas_cumprod`` at
+            the sampled timesteps, broadcastable to ``latents``.
+        sqrt_one_minus_alpha_prod (torch.Tensor): Square root of
+            ``1 - alphas_cumprod`` at the sampled timesteps, broadcastable to
+            ``latents``.
+        weight (torch.Tensor, optional): Sample-wise loss weight.
+            Defaults to None.
+    """
+    diff = pred - (
+        sqrt_alpha_prod * noise - sqrt_one_minus_alpha_prod * latents)
+    loss = diff * diff
+    if weight is not None:
+        loss = loss * weight
+    return loss.mean()
+
+
 @MODELS.register_module()
 class L2Loss(nn.Module):
     """L2 loss.
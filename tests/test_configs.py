@@ -0,0 +1,13 @@
+from glob import glob
+
+import pytest
+from mmengine.config import Config
+
+SDXL_CONFIGS = sorted(glob('configs/stable_diffusion_xl*/*.py'))
+
+
+@pytest.mark.parametrize('config', SDXL_CONFIGS)
+def test_sdxl_mixed_precision_matches_optim_wrapper(config):
+    # frozen weights in another dtype than autocast are re-cast every step
+    cfg = Config.fromfile(config)
+    assert cfg.model.mixed_precision == cfg.optim_wrapper.dtype
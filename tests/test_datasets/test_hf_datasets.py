@@ -1,3 +1,4 @@
+import numpy as np
 from mmengine.testing import RunnerTestCase
 from PIL import Image
 
@@ -13,5 +14,35 @@ class TestHFDataset(RunnerTestCase):
 
         data = dataset[0]
         assert data['text'] == 'a dog'
+        assert data['idx'] == 0
         self.assertIsInstance(data['img'], Image.Image)
         assert data['img'].width == 400
+
+    def test_dataset_pretokenize(self):
+        dataset = HFDataset(
+            dataset='tests/testdata/dataset',
+            image_column='file_name',
+            pretokenize=[
+                dict(
+                    model='diffusers/tiny-stable-diffusion-torch',
+                    output_key='input_ids')
+            ])
+        assert len(dataset) == 1
+
+        data = dataset[0]
+        assert data['text'] == 'a dog'
+        assert data['input_ids'].dtype == np.int32
+        assert data['input_ids'].ndim == 1
+
+    def test_dataset_without_image(self):
+        dataset = HFDataset(
+            dataset='tests/testdata/dataset',
+            image_column='file_name',
+            load_image=False)
+        assert len(dataset) == 1
+        assert 'file_name' not in dataset.dataset.column_names
+
+        data = dataset[0]
+        assert data['text'] == 'a dog'
+        assert data['idx'] == 0
+        assert 'img' not in data
@@ -1,4 +1,5 @@
 import os.path as osp
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
 import numpy as np
@@ -8,6 +9,7 @@ from mmengine.dataset.base_dataset import Compose
 from mmengine.utils import digit_version
 from PIL import Image
 from torchvision import transforms
+from torchvision.transforms.functional import pil_to_tensor
 
 from diffengine.datasets.transforms.processing import VISION_TRANSFORMS
 from diffengine.registry import TRANSFORMS
@@ -99,6 +101,11 @@ class TestSaveImageShape(TestCase):
         data = trans(data)
         self.assertListEqual(data['ori_img_shape'], ori_img_shape)
 
+        # test tensor image
+        data = {'img': pil_to_tensor(Image.open(img_path))}
+        data = trans(data)
+        self.assertListEqual(data['ori_img_shape'], ori_img_shape)
+
 
 class TestComputeTimeIds(TestCase):
 
@@ -116,6 +123,16 @@ class TestComputeTimeIds(TestCase):
         self.assertListEqual(data['time_ids'],
                              [32, 32, 0, 0, img.height, img.width])
 
+        # test tensor image
+        data = {
+            'img': pil_to_tensor(img),
+            'ori_img_shape': [32, 32],
+            'crop_top_left': [0, 0]
+        }
+        data = trans(data)
+        self.assertListEqual(data['time_ids'],
+                             [32, 32, 0, 0, img.height, img.width])
+
 
 class TestRandomCropWithCropPoint(TestCase):
     crop_size = 32
@@ -168,6 +185,12 @@ class TestCenterCropWithCropPoint(TestCase):
             np.array(data['img']),
             np.array(Image.open(img_path).crop((left, upper, right, lower))))
 
+        # test tensor image
+        tensor_data = trans({'img': pil_to_tensor(Image.open(img_path))})
+        assert tensor_data['img'].shape[1:] == (self.crop_size, self.crop_size)
+        self.assertListEqual(tensor_data['crop_top_left'], [upper, left])
+        self.assertListEqual(tensor_data['crop_bottom_right'], [lower, right])
+
 
 class TestRandomHorizontalFlipFixCropPoint(TestCase):
 
@@ -195,6 +218,17 @@ class TestRandomHorizontalFlipFixCropPoint(TestCase):
             np.array(data['img']),
             np.array(Image.open(img_path).transpose(Image.FLIP_LEFT_RIGHT)))
 
+        # test tensor image
+        img = pil_to_tensor(Image.open(img_path))
+        tensor_data = trans({
+            'img': img,
+            'crop_top_left': [0, 0],
+            'crop_bottom_right': [10, 10]
+        })
+        self.assertListEqual(tensor_data['crop_top_left'],
+                             [0, img.shape[2] - 10])
+        assert torch.equal(tensor_data['img'], img.flip(-1))
+
         # test transform p=0.0
         data = {
             'img': Image.open(img_path),
@@ -208,3 +242,54 @@ class TestRandomHorizontalFlipFixCropPoint(TestCase):
         self.assertListEqual(data['crop_top_left'], [0, 0])
 
         np.equal(np.array(data['img']), np.array(Image.open(img_path)))
+
+
+class TestTokenizeCLIP(TestCase):
+
+    def test_register(self):
+        self.assertIn('TokenizeCLIP', TRANSFORMS)
+
+    def test_transform(self):
+        data = {'text': 'a dog'}
+
+        # test transform
+        trans = TRANSFORMS.build(
+            dict(
+                type='TokenizeCLIP',
+                model='diffusers/tiny-stable-diffusion-torch'))
+        data = trans(data)
+        self.assertIn('input_ids', data)
+        self.assertIsInstance(data['input_ids'], torch.Tensor)
+        assert data['input_ids'].shape == (trans.tokenizer.model_max_length, )
+
+        # test output_key
+        trans = TRANSFORMS.build(
+            dict(
+                type='TokenizeCLIP',
+                model='diffusers/tiny-stable-diffusion-torch',
+                output_key='input_ids_one'))
+        data = trans({'text': 'a dog'})
+        self.assertIn('input_ids_one', data)
+
+
+class TestLoadPrecomputedLatent(TestCase):
+
+    def test_register(self):
+        self.assertIn('LoadPrecomputedLatent', TRANSFORMS)
+
+    def test_transform(self):
+        with TemporaryDirectory() as tmpdir:
+            parameters = np.random.randn(8, 4, 4).astype(np.float32)
+            np.save(osp.join(tmpdir, '3.npy'), parameters)
+            data = {'idx': 3}
+
+            # test transform
+            trans = TRANSFORMS.build(
+                dict(type='LoadPrecomputedLatent', latent_dir=tmpdir))
+            data = trans(data)
+            assert data['latent_mean'].shape == (4, 4, 4)
+            assert data['latent_logvar'].shape == (4, 4, 4)
+            np.testing.assert_allclose(data['latent_mean'].numpy(),
+                                       parameters[:4])
+            np.testing.assert_allclose(data['latent_logvar'].numpy(),
+                                       parameters[4:])
@@ -34,6 +34,11 @@ class TestVisualizationHook(RunnerTestCase):
         hook = VisualizationHook(prompt=['a dog'])
         hook.after_train_epoch(runner)
 
+        # test batch_size is passed to infer
+        hook = VisualizationHook(prompt=['a dog'] * 3, batch_size=2)
+        hook.after_train_epoch(runner)
+        runner.model.infer.assert_called_with(['a dog'] * 3, batch_size=2)
+
     def test_after_train_iter(self):
         cfg = copy.deepcopy(self.iter_based_cfg)
         cfg.train_cfg.max_iters = 100
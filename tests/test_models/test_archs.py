@@ -1,8 +1,15 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+import torch
 from diffusers import UNet2DConditionModel
 from diffusers.loaders import text_encoder_lora_state_dict
 from transformers import CLIPTextModel
 
-from diffengine.models.archs import (set_text_encoder_lora, set_unet_lora,
+from diffengine.models.archs import (CPUOffloader, fused_diffuse,
+                                     replace_linear_with_int8,
+                                     set_text_encoder_lora, set_unet_lora,
                                      unet_attn_processors_state_dict)
 from diffengine.models.editors import SDDataPreprocessor, StableDiffusion
 
@@ -34,3 +41,145 @@ def test_unet_lora_layers_to_save():
         model.text_encoder)
     assert len(unet_lora_layers_to_save) > 0
     assert len(text_encoder_lora_layers_to_save) > 0
+
+
+def test_replace_linear_with_int8():
+    bnb = pytest.importorskip('bitsandbytes')
+    text_encoder = CLIPTextModel.from_pretrained(
+        'diffusers/tiny-stable-diffusion-torch', subfolder='text_encoder')
+    text_encoder.requires_grad_(False)
+    q_proj = text_encoder.text_model.encoder.layers[0].self_attn.q_proj
+    replace_linear_with_int8(text_encoder)
+
+    int8_q_proj = text_encoder.text_model.encoder.layers[0].self_attn.q_proj
+    assert isinstance(int8_q_proj, bnb.nn.Linear8bitLt)
+    assert torch.equal(int8_q_proj.weight.data, q_proj.weight.data)
+    assert not any(
+        isinstance(m, torch.nn.Linear)
+        and not isinstance(m, bnb.nn.Linear8bitLt)
+        for m in text_encoder.modules())
+
+
+def _stub_bitsandbytes():
+    """A bitsandbytes stub whose int8 layers keep float weights."""
+
+    class Int8Params(torch.nn.Parameter):
+
+        def __new__(cls,
+                    data=None,
+                    requires_grad=True,
+                    has_fp16_weights=False):
+            return super().__new__(cls, data, requires_grad)
+
+    class Linear8bitLt(torch.nn.Linear):
+
+        def __init__(self,
+                     in_features,
+                     out_features,
+                     bias=True,
+                     has_fp16_weights=True,
+                     threshold=0.0):
+            super().__init__(in_features, out_features, bias=bias)
+            self.threshold = threshold
+
+    return SimpleNamespace(
+        nn=SimpleNamespace(Linear8bitLt=Linear8bitLt, Int8Params=Int8Params))
+
+
+def test_replace_linear_with_int8_stub(monkeypatch):
+    bnb = _stub_bitsandbytes()
+    monkeypatch.setitem(sys.modules, 'bitsandbytes', bnb)
+    text_encoder = CLIPTextModel.from_pretrained(
+        'diffusers/tiny-stable-diffusion-torch', subfolder='text_encoder')
+    text_encoder.requires_grad_(False)
+    input_ids = torch.arange(4)[None]
+    expected = text_encoder(input_ids)[0]
+    num_linears = sum(
+        isinstance(m, torch.nn.Linear) for m in text_encoder.modules())
+
+    replace_linear_with_int8(text_encoder, threshold=5.0)
+    linears = [
+        m for m in text_encoder.modules() if isinstance(m, torch.nn.Linear)
+    ]
+    assert len(linears) == num_linears
+    assert all(isinstance(m, bnb.nn.Linear8bitLt) for m in linears)
+    assert all(m.threshold == 5.0 for m in linears)
+    assert all(isinstance(m.weight, bnb.nn.Int8Params) for m in linears)
+    assert not any(p.requires_grad for p in text_encoder.parameters())
+    # the stub keeps float weights, so the outputs are unchanged
+    assert torch.allclose(text_encoder(input_ids)[0], expected)
+
+    # test the frozen text encoder of the model is quantized
+    StableDiffuser = StableDiffusion(
+        'diffusers/tiny-stable-diffusion-torch',
+        data_preprocessor=SDDataPreprocessor(),
+        quantize_frozen=True)
+    q_proj = StableDiffuser.text_encoder.text_model.encoder.layers[
+        0].self_attn.q_proj
+    assert isinstance(q_proj, bnb.nn.Linear8bitLt)
+    assert not any(p.requires_grad
+                   for p in StableDiffuser.text_encoder.parameters())
+    assert not any(
+        isinstance(m, bnb.nn.Linear8bitLt)
+        for m in StableDiffuser.unet.modules())
+
+
+def test_cpu_offloader():
+    module = torch.nn.Linear(4, 4).requires_grad_(False)
+    weight = module.weight.data.clone()
+    offloader = CPUOffloader(module)
+    with offloader.onload(torch.device('cpu')):
+        out = module(torch.ones(1, 4))
+    assert offloader.cpu_weights is not None
+    assert module.weight.device.type == 'cpu'
+    assert torch.equal(module.weight.data, weight)
+
+    # test onload after offload
+    with offloader.onload(torch.device('cpu')):
+        assert torch.equal(module(torch.ones(1, 4)), out)
+
+    # test disabled
+    offloader = CPUOffloader([module], enabled=False)
+    with offloader.onload(torch.device('cpu')):
+        pass
+    assert offloader.cpu_weights is None
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available(), reason='requires a CUDA device')
+def test_fused_diffuse():
+    pytest.importorskip('triton')
+    latents = torch.randn(2, 4, 16, 16, device='cuda')
+    sqrt_alpha_prod = 0.9 * torch.rand(2, device='cuda').view(-1, 1, 1, 1)
+    sqrt_one_minus_alpha_prod = (1 - sqrt_alpha_prod**2).sqrt()
+
+    # the target is the noise
+    noisy_latents, gt = fused_diffuse(latents, sqrt_alpha_prod,
+                                      sqrt_one_minus_alpha_prod)
+    assert torch.allclose(
+        noisy_latents,
+        sqrt_alpha_prod * latents + sqrt_one_minus_alpha_prod * gt,
+        atol=1e-5)
+    assert abs(gt.mean().item()) < 0.1 and abs(gt.std().item() - 1) < 0.1
+
+    # test v_prediction with noise offset and channels_last
+    latents = latents.contiguous(memory_format=torch.channels_last)
+    noise_offset = torch.randn(2, 4, device='cuda')
+    noisy_latents, gt = fused_diffuse(
+        latents,
+        sqrt_alpha_prod,
+        sqrt_one_minus_alpha_prod,
+        noise_offset=noise_offset,
+        v_prediction=True)
+    assert noisy_latents.is_contiguous(memory_format=torch.channels_last)
+    noise = (noisy_latents -
+             sqrt_alpha_prod * latents) / sqrt_one_minus_alpha_prod
+    assert torch.allclose(
+        gt,
+        sqrt_alpha_prod * noise - sqrt_one_minus_alpha_prod * latents,
+        atol=1e-4)
+    # the offset is shared by all pixels of a channel
+    assert torch.allclose(
+        (noise - noise_offset.view(2, 4, 1, 1)).mean(dim=(0, 2, 3)),
+        torch.zeros(4, device='cuda'),
+        atol=0.3)
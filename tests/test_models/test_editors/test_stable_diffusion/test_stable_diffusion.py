@@ -1,11 +1,15 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
+from unittest.mock import patch
 
+import diffusers
+import numpy as np
 import torch
+from diffusers.utils import is_xformers_available
 from mmengine.optim import OptimWrapper
 from torch.optim import SGD
 
 from diffengine.models.editors import SDDataPreprocessor, StableDiffusion
-from diffengine.models.losses import L2Loss
+from diffengine.models.losses import L2Loss, v_prediction_l2_loss
 
 
 class TestStableDiffusion(TestCase):
@@ -22,10 +26,58 @@ class TestStableDiffusion(TestCase):
             width=64)
         assert len(result) == 1
         assert result[0].shape == (64, 64, 3)
+        assert result[0].dtype == np.uint8
+        assert result[0].flags['C_CONTIGUOUS']
+
+        # test pipeline is cached across infer calls
+        pipeline = StableDiffuser._pipeline
+        assert pipeline is not None
+        StableDiffuser.infer(['a dog'], height=64, width=64)
+        assert StableDiffuser._pipeline is pipeline
+        StableDiffuser.release_pipeline()
+        assert StableDiffuser._pipeline is None
+
+        # test batched prompts
+        result = StableDiffuser.infer(['a dog', 'a cat', 'a bird'],
+                                      height=64,
+                                      width=64,
+                                      batch_size=2)
+        assert len(result) == 3
+        assert result[2].shape == (64, 64, 3)
 
         # test device
         assert StableDiffuser.device.type == 'cpu'
 
+    @skipIf(not torch.cuda.is_available() or not is_xformers_available(),
+            'xFormers attention requires CUDA and xformers')
+    def test_infer_restores_attn_processors(self):
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            data_preprocessor=SDDataPreprocessor()).to('cuda')
+        unet_processors = StableDiffuser.unet.attn_processors
+        vae_processors = StableDiffuser.vae.attn_processors
+
+        # xFormers attention must not leak into training
+        StableDiffuser.infer(['a dog'], height=64, width=64)
+        assert StableDiffuser.unet.attn_processors == unet_processors
+        assert StableDiffuser.vae.attn_processors == vae_processors
+
+    @skipIf(not hasattr(diffusers, 'AutoencoderTiny'),
+            'AutoencoderTiny requires diffusers>=0.20.0')
+    def test_infer_with_tiny_vae(self):
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            tiny_vae_model='madebyollin/taesd',
+            data_preprocessor=SDDataPreprocessor())
+
+        result = StableDiffuser.infer(['a dog'], height=64, width=64)
+        assert len(result) == 1
+        assert result[0].shape == (64, 64, 3)
+        # the tiny vae is only used by the pipeline
+        assert isinstance(StableDiffuser._pipeline.vae,
+                          diffusers.AutoencoderTiny)
+        assert isinstance(StableDiffuser.vae, diffusers.AutoencoderKL)
+
     def test_train_step(self):
         # test load with loss module
         StableDiffuser = StableDiffusion(
@@ -42,6 +94,210 @@ class TestStableDiffusion(TestCase):
         assert log_vars
         self.assertIsInstance(log_vars['loss'], torch.Tensor)
 
+    def test_train_step_with_cpu_offload(self):
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            cpu_offload=True,
+            data_preprocessor=SDDataPreprocessor())
+
+        # test train step
+        data = dict(
+            inputs=dict(img=[torch.zeros((3, 64, 64))], text=['a dog']))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        log_vars = StableDiffuser.train_step(data, optim_wrapper)
+        assert log_vars
+        self.assertIsInstance(log_vars['loss'], torch.Tensor)
+        assert StableDiffuser.vae_offloader.cpu_weights is not None
+        assert StableDiffuser.text_encoder_offloader.cpu_weights is not None
+
+        # test infer after offloading
+        result = StableDiffuser.infer(['a dog'], height=64, width=64)
+        assert result[0].shape == (64, 64, 3)
+
+    def test_train_step_with_input_ids(self):
+        # test load with loss module
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            loss=L2Loss(),
+            data_preprocessor=SDDataPreprocessor())
+
+        # test train step with text tokenized in the data pipeline
+        input_ids = StableDiffuser.tokenizer(
+            'a dog',
+            max_length=StableDiffuser.tokenizer.model_max_length,
+            padding='max_length',
+            truncation=True,
+            return_tensors='pt').input_ids[0]
+        data = dict(
+            inputs=dict(img=[torch.zeros((3, 64, 64))], input_ids=[input_ids]))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        log_vars = StableDiffuser.train_step(data, optim_wrapper)
+        assert log_vars
+        self.assertIsInstance(log_vars['loss'], torch.Tensor)
+
+        # test ids padded by the tokenizer of another model
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            loss=L2Loss(),
+            data_preprocessor=SDDataPreprocessor())
+        input_ids[-1] = StableDiffuser.tokenizer.pad_token_id + 1
+        data = dict(
+            inputs=dict(img=[torch.zeros((3, 64, 64))], input_ids=[input_ids]))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        with self.assertRaisesRegex(ValueError, 'pretokenize'):
+            StableDiffuser.train_step(data, optim_wrapper)
+
+    def test_train_step_with_cached_latent(self):
+        # test load with loss module
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            loss=L2Loss(),
+            data_preprocessor=SDDataPreprocessor())
+
+        # test train step with latents cached by tools/cache_latents.py
+        data = dict(
+            inputs=dict(
+                latent_mean=[torch.zeros((4, 8, 8))],
+                latent_logvar=[torch.zeros((4, 8, 8))],
+                text=['a dog']))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        log_vars = StableDiffuser.train_step(data, optim_wrapper)
+        assert log_vars
+        self.assertIsInstance(log_vars['loss'], torch.Tensor)
+
+    def test_train_step_with_mixed_precision(self):
+        # test load with loss module
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            loss=L2Loss(),
+            data_preprocessor=SDDataPreprocessor(),
+            mixed_precision='bfloat16')
+        assert StableDiffuser.vae.dtype == torch.bfloat16
+        assert StableDiffuser.unet.dtype == torch.float32
+
+        # test train step
+        data = dict(
+            inputs=dict(img=[torch.zeros((3, 64, 64))], text=['a dog']))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        log_vars = StableDiffuser.train_step(data, optim_wrapper)
+        assert log_vars
+        self.assertIsInstance(log_vars['loss'], torch.Tensor)
+
+    def test_noise_offset(self):
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            loss=L2Loss(),
+            data_preprocessor=SDDataPreprocessor(),
+            noise_offset_weight=0.05)
+
+        # record the noise before the offset is added to it in place, the
+        # offset and the target passed to the loss
+        draws = dict()
+        randn, randn_like = torch.randn, torch.randn_like
+
+        def record_randn(*args, **kwargs):
+            out = randn(*args, **kwargs)
+            if out.shape[-2:] == (1, 1):
+                draws['offset'] = out
+            return out
+
+        def record_randn_like(*args, **kwargs):
+            out = randn_like(*args, **kwargs)
+            draws['noise'] = out.clone()
+            return out
+
+        loss_forward = StableDiffuser.loss_module.forward
+
+        def record_loss(pred, gt, *args, **kwargs):
+            draws['gt'] = gt.clone()
+            return loss_forward(pred, gt, *args, **kwargs)
+
+        torch.manual_seed(0)
+        data = dict(
+            inputs=dict(img=[torch.zeros((3, 64, 64))], text=['a dog']))
+        data = StableDiffuser.data_preprocessor(data)
+        with patch('torch.randn', side_effect=record_randn), \
+                patch('torch.randn_like', side_effect=record_randn_like), \
+                patch.object(StableDiffuser.loss_module, 'forward',
+                             side_effect=record_loss):
+            StableDiffuser(**data, mode='loss')
+
+        # the in-place offset gives the out-of-place result
+        expected = draws['noise'] + 0.05 * draws['offset']
+        assert torch.allclose(draws['gt'], expected)
+
+    def test_compile_unet(self):
+        with patch('torch.compile') as torch_compile:
+            StableDiffuser = StableDiffusion(
+                'diffusers/tiny-stable-diffusion-torch',
+                data_preprocessor=SDDataPreprocessor())
+        torch_compile.assert_not_called()
+        assert 'forward' not in StableDiffuser.unet.__dict__
+
+        with patch('torch.compile') as torch_compile:
+            StableDiffuser = StableDiffusion(
+                'diffusers/tiny-stable-diffusion-torch',
+                data_preprocessor=SDDataPreprocessor(),
+                compile_unet=True)
+        unet = StableDiffuser.unet
+        torch_compile.assert_called_once_with(
+            type(unet).forward.__get__(unet),
+            mode='max-autotune',
+            dynamic=False)
+        assert unet.forward is torch_compile.return_value
+        # test state dict keys are kept
+        assert not any('_orig_mod' in k for k in StableDiffuser.state_dict())
+
+    def test_channels_last(self):
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            data_preprocessor=SDDataPreprocessor(),
+            channels_last=True)
+        for module in (StableDiffuser.unet, StableDiffuser.vae):
+            for param in module.parameters():
+                if param.ndim == 4:
+                    assert param.is_contiguous(
+                        memory_format=torch.channels_last)
+
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            data_preprocessor=SDDataPreprocessor())
+        assert not StableDiffuser.unet.conv_in.weight.is_contiguous(
+            memory_format=torch.channels_last)
+
+    def test_train_step_with_v_prediction(self):
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            loss=L2Loss(),
+            data_preprocessor=SDDataPreprocessor())
+        StableDiffuser.scheduler.register_to_config(
+            prediction_type='v_prediction')
+
+        class UnfusedL2Loss(L2Loss):
+            """Subclasses get the velocity target and run their forward."""
+
+        data = dict(
+            inputs=dict(img=[torch.zeros((3, 64, 64))], text=['a dog']))
+        # lr=0 keeps the weights, so both steps predict the same
+        optim_wrapper = OptimWrapper(SGD(StableDiffuser.parameters(), lr=0))
+        fused_path = f'{StableDiffusion.__module__}.v_prediction_l2_loss'
+        torch.manual_seed(0)
+        with patch(fused_path, wraps=v_prediction_l2_loss) as fused:
+            fused_loss = StableDiffuser.train_step(data, optim_wrapper)['loss']
+        fused.assert_called_once()
+
+        StableDiffuser.loss_module = UnfusedL2Loss()
+        torch.manual_seed(0)
+        with patch(fused_path, wraps=v_prediction_l2_loss) as fused:
+            loss = StableDiffuser.train_step(data, optim_wrapper)['loss']
+        fused.assert_not_called()
+        assert torch.allclose(fused_loss, loss)
+
     def test_train_step_with_gradient_checkpointing(self):
         # test load with loss module
         StableDiffuser = StableDiffusion(
@@ -77,6 +333,30 @@ class TestStableDiffusion(TestCase):
         assert log_vars
         self.assertIsInstance(log_vars['loss'], torch.Tensor)
 
+    def test_noise_schedule_buffers(self):
+        StableDiffuser = StableDiffusion(
+            'diffusers/tiny-stable-diffusion-torch',
+            data_preprocessor=SDDataPreprocessor())
+
+        # test buffers match the scheduler
+        latents = torch.randn((2, 4, 8, 8))
+        noise = torch.randn((2, 4, 8, 8))
+        timesteps = torch.tensor([1, 500])
+        sqrt_alpha_prod = StableDiffuser.sqrt_alphas_cumprod[timesteps]
+        sqrt_alpha_prod = sqrt_alpha_prod.view(-1, 1, 1, 1)
+        sqrt_one_minus_alpha_prod = (
+            StableDiffuser.sqrt_one_minus_alphas_cumprod[timesteps])
+        sqrt_one_minus_alpha_prod = sqrt_one_minus_alpha_prod.view(-1, 1, 1, 1)
+        torch.testing.assert_close(
+            sqrt_alpha_prod * latents + sqrt_one_minus_alpha_prod * noise,
+            StableDiffuser.scheduler.add_noise(latents, noise, timesteps))
+        torch.testing.assert_close(
+            sqrt_alpha_prod * noise - sqrt_one_minus_alpha_prod * latents,
+            StableDiffuser.scheduler.get_velocity(latents, noise, timesteps))
+
+        # test buffers are not saved
+        self.assertNotIn('sqrt_alphas_cumprod', StableDiffuser.state_dict())
+
     def test_val_and_test_step(self):
         StableDiffuser = StableDiffusion(
             'diffusers/tiny-stable-diffusion-torch',
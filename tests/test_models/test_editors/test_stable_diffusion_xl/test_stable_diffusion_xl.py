@@ -1,11 +1,14 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
+from unittest.mock import patch
 
+import numpy as np
 import torch
+from diffusers.utils import is_xformers_available
 from mmengine.optim import OptimWrapper
 from torch.optim import SGD
 
 from diffengine.models.editors import SDXLDataPreprocessor, StableDiffusionXL
-from diffengine.models.losses import L2Loss
+from diffengine.models.losses import L2Loss, v_prediction_l2_loss
 
 
 class TestStableDiffusionXL(TestCase):
@@ -22,10 +25,43 @@ class TestStableDiffusionXL(TestCase):
             width=64)
         assert len(result) == 1
         assert result[0].shape == (64, 64, 3)
+        assert result[0].dtype == np.uint8
+        assert result[0].flags['C_CONTIGUOUS']
+
+        # test pipeline is cached across infer calls
+        pipeline = StableDiffuser._pipeline
+        assert pipeline is not None
+        StableDiffuser.infer(['a dog'], height=64, width=64)
+        assert StableDiffuser._pipeline is pipeline
+        StableDiffuser.release_pipeline()
+        assert StableDiffuser._pipeline is None
+
+        # test batched prompts
+        result = StableDiffuser.infer(['a dog', 'a cat', 'a bird'],
+                                      height=64,
+                                      width=64,
+                                      batch_size=2)
+        assert len(result) == 3
+        assert result[2].shape == (64, 64, 3)
+        assert result[2].dtype == np.uint8
 
         # test device
         assert StableDiffuser.device.type == 'cpu'
 
+    @skipIf(not torch.cuda.is_available() or not is_xformers_available(),
+            'xFormers attention requires CUDA and xformers')
+    def test_infer_restores_attn_processors(self):
+        StableDiffuser = StableDiffusionXL(
+            'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+            data_preprocessor=SDXLDataPreprocessor()).to('cuda')
+        unet_processors = StableDiffuser.unet.attn_processors
+        vae_processors = StableDiffuser.vae.attn_processors
+
+        # xFormers attention must not leak into training
+        StableDiffuser.infer(['a dog'], height=64, width=64)
+        assert StableDiffuser.unet.attn_processors == unet_processors
+        assert StableDiffuser.vae.attn_processors == vae_processors
+
     def test_train_step(self):
         # test load with loss module
         StableDiffuser = StableDiffusionXL(
@@ -45,6 +81,192 @@ class TestStableDiffusionXL(TestCase):
         assert log_vars
         self.assertIsInstance(log_vars['loss'], torch.Tensor)
 
+    def test_train_step_with_input_ids(self):
+        # test load with loss module
+        StableDiffuser = StableDiffusionXL(
+            'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+            loss=L2Loss(),
+            data_preprocessor=SDXLDataPreprocessor())
+
+        # test train step with text tokenized in the data pipeline
+        input_ids_one = StableDiffuser.tokenizer_one(
+            'a dog',
+            max_length=StableDiffuser.tokenizer_one.model_max_length,
+            padding='max_length',
+            truncation=True,
+            return_tensors='pt').input_ids[0]
+        input_ids_two = StableDiffuser.tokenizer_two(
+            'a dog',
+            max_length=StableDiffuser.tokenizer_two.model_max_length,
+            padding='max_length',
+            truncation=True,
+            return_tensors='pt').input_ids[0]
+        data = dict(
+            inputs=dict(
+                img=[torch.zeros((3, 64, 64))],
+                input_ids_one=[input_ids_one],
+                input_ids_two=[input_ids_two],
+                time_ids=[torch.zeros((1, 6))]))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        log_vars = StableDiffuser.train_step(data, optim_wrapper)
+        assert log_vars
+        self.assertIsInstance(log_vars['loss'], torch.Tensor)
+
+        # test ids padded by the tokenizer of another model
+        StableDiffuser = StableDiffusionXL(
+            'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+            loss=L2Loss(),
+            data_preprocessor=SDXLDataPreprocessor())
+        input_ids_two[-1] = StableDiffuser.tokenizer_two.pad_token_id + 1
+        data = dict(
+            inputs=dict(
+                img=[torch.zeros((3, 64, 64))],
+                input_ids_one=[input_ids_one],
+                input_ids_two=[input_ids_two],
+                time_ids=[torch.zeros((1, 6))]))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        with self.assertRaisesRegex(ValueError, 'input_ids_two'):
+            StableDiffuser.train_step(data, optim_wrapper)
+
+    def test_train_step_with_mixed_precision(self):
+        # test load with loss module
+        StableDiffuser = StableDiffusionXL(
+            'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+            loss=L2Loss(),
+            data_preprocessor=SDXLDataPreprocessor(),
+            mixed_precision='bfloat16')
+        assert StableDiffuser.vae.dtype == torch.bfloat16
+        assert StableDiffuser.unet.dtype == torch.float32
+
+        # test train step
+        data = dict(
+            inputs=dict(
+                img=[torch.zeros((3, 64, 64))],
+                text=['a dog'],
+                time_ids=[torch.zeros((1, 6))]))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        log_vars = StableDiffuser.train_step(data, optim_wrapper)
+        assert log_vars
+        self.assertIsInstance(log_vars['loss'], torch.Tensor)
+
+    def test_compile_unet(self):
+        with patch('torch.compile') as torch_compile:
+            StableDiffuser = StableDiffusionXL(
+                'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+                data_preprocessor=SDXLDataPreprocessor())
+        torch_compile.assert_not_called()
+        assert 'forward' not in StableDiffuser.unet.__dict__
+
+        with patch('torch.compile') as torch_compile:
+            StableDiffuser = StableDiffusionXL(
+                'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+                data_preprocessor=SDXLDataPreprocessor(),
+                compile_unet=dict(backend='eager'))
+        unet = StableDiffuser.unet
+        torch_compile.assert_called_once_with(
+            type(unet).forward.__get__(unet), backend='eager')
+        assert unet.forward is torch_compile.return_value
+        # test state dict keys are kept
+        assert not any('_orig_mod' in k for k in StableDiffuser.state_dict())
+
+    def test_channels_last(self):
+        StableDiffuser = StableDiffusionXL(
+            'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+            data_preprocessor=SDXLDataPreprocessor(),
+            channels_last=True)
+        for module in (StableDiffuser.unet, StableDiffuser.vae):
+            for param in module.parameters():
+                if param.ndim == 4:
+                    assert param.is_contiguous(
+                        memory_format=torch.channels_last)
+
+        StableDiffuser = StableDiffusionXL(
+            'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+            data_preprocessor=SDXLDataPreprocessor())
+        assert not StableDiffuser.unet.conv_in.weight.is_contiguous(
+            memory_format=torch.channels_last)
+
+    def test_train_step_with_v_prediction(self):
+        StableDiffuser = StableDiffusionXL(
+            'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+            loss=L2Loss(),
+            data_preprocessor=SDXLDataPreprocessor())
+        StableDiffuser.scheduler.register_to_config(
+            prediction_type='v_prediction')
+
+        class UnfusedL2Loss(L2Loss):
+            """Subclasses get the velocity target and run their forward."""
+
+        data = dict(
+            inputs=dict(
+                img=[torch.zeros((3, 64, 64))],
+                text=['a dog'],
+                time_ids=[torch.zeros((1, 6))]))
+        # lr=0 keeps the weights, so both steps predict the same
+        optim_wrapper = OptimWrapper(SGD(StableDiffuser.parameters(), lr=0))
+        fused_path = f'{StableDiffusionXL.__module__}.v_prediction_l2_loss'
+        torch.manual_seed(0)
+        with patch(fused_path, wraps=v_prediction_l2_loss) as fused:
+            fused_loss = StableDiffuser.train_step(data, optim_wrapper)['loss']
+        fused.assert_called_once()
+
+        StableDiffuser.loss_module = UnfusedL2Loss()
+        torch.manual_seed(0)
+        with patch(fused_path, wraps=v_prediction_l2_loss) as fused:
+            loss = StableDiffuser.train_step(data, optim_wrapper)['loss']
+        fused.assert_not_called()
+        assert torch.allclose(fused_loss, loss)
+
+    def test_train_step_with_cpu_offload(self):
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        StableDiffuser = StableDiffusionXL(
+            'hf-internal-testing/tiny-stable-diffusion-xl-pipe',
+            cpu_offload=True,
+            data_preprocessor=SDXLDataPreprocessor()).to(device)
+        offloaded = dict(
+            text_encoder_one=StableDiffuser.text_encoder_one,
+            text_encoder_two=StableDiffuser.text_encoder_two,
+            vae=StableDiffuser.vae.encoder)
+
+        # record where the weights are when the offloaded modules run
+        devices = dict()
+
+        def record_device(name):
+
+            def hook(module, args):
+                devices[name] = next(module.parameters()).device
+
+            return hook
+
+        for name, module in offloaded.items():
+            module.register_forward_pre_hook(record_device(name))
+
+        data = dict(
+            inputs=dict(
+                img=[torch.zeros((3, 64, 64))],
+                text=['a dog'],
+                time_ids=[torch.zeros((1, 6))]))
+        optimizer = SGD(StableDiffuser.parameters(), lr=0.1)
+        optim_wrapper = OptimWrapper(optimizer)
+        StableDiffuser.train_step(data, optim_wrapper)
+        unet_device = StableDiffuser.device
+        assert devices == {name: unet_device for name in offloaded}
+
+        # the weights are the cpu copies between steps
+        for offloader in (StableDiffuser.vae_offloader,
+                          StableDiffuser.text_encoder_offloader):
+            assert offloader.cpu_weights is not None
+            for p, cpu_weight in zip(offloader.parameters(),
+                                     offloader.cpu_weights):
+                assert p.device.type == 'cpu'
+                assert p.data_ptr() == cpu_weight.data_ptr()
+            with offloader.onload(unet_device):
+                assert all(p.device == unet_device
+                           for p in offloader.parameters())
+
     def test_train_step_with_gradient_checkpointing(self):
         # test load with loss module
         StableDiffuser = StableDiffusionXL(
@@ -1,7 +1,7 @@
 import torch
 from diffusers import StableDiffusionPipeline
 
-from diffengine.models.losses import L2Loss, SNRL2Loss
+from diffengine.models.losses import L2Loss, SNRL2Loss, v_prediction_l2_loss
 
 
 def test_l2_loss():
@@ -15,6 +15,29 @@ def test_l2_loss():
     assert torch.allclose(loss(pred, gt, weight=weight), torch.tensor(8.0167))
 
 
+def test_v_prediction_l2_loss():
+    pred = torch.randn(2, 4, 8, 8)
+    latents = torch.randn(2, 4, 8, 8)
+    noise = torch.randn(2, 4, 8, 8)
+    sqrt_alpha_prod = torch.rand(2).view(-1, 1, 1, 1)
+    sqrt_one_minus_alpha_prod = (1 - sqrt_alpha_prod**2).sqrt()
+    weight = torch.Tensor([1, 0.1]).view(-1, 1, 1, 1)
+    gt = sqrt_alpha_prod * noise - sqrt_one_minus_alpha_prod * latents
+
+    loss = L2Loss()
+    assert torch.allclose(
+        v_prediction_l2_loss(pred, latents, noise, sqrt_alpha_prod,
+                             sqrt_one_minus_alpha_prod), loss(pred, gt))
+    assert torch.allclose(
+        v_prediction_l2_loss(
+            pred,
+            latents,
+            noise,
+            sqrt_alpha_prod,
+            sqrt_one_minus_alpha_prod,
+            weight=weight), loss(pred, gt, weight=weight))
+
+
 def test_snr_l2_loss():
     # test asymmetric_loss
     pred = torch.Tensor([[5, -5, 0], [5, -5, 0]])
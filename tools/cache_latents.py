@@ -0,0 +1,69 @@
+import argparse
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKL
+from mmengine.registry import init_default_scope
+from tqdm import tqdm
+
+from diffengine.datasets import HFDataset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Cache VAE latents of a dataset for LoadPrecomputedLatent')
+    parser.add_argument('dataset', help='Dataset name or path to dataset')
+    parser.add_argument('out_dir', help='output dir')
+    parser.add_argument(
+        '--sdmodel',
+        help='Stable Diffusion model name',
+        default='runwayml/stable-diffusion-v1-5')
+    parser.add_argument(
+        '--image-column', help='Image column name', default='image')
+    parser.add_argument(
+        '--caption-column', help='Caption column name', default='text')
+    parser.add_argument(
+        '--size', type=int, help='Image size to encode', default=512)
+    parser.add_argument(
+        '--device', help='Device used for encoding', default='cuda')
+    args = parser.parse_args()
+    return args
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    init_default_scope('diffengine')
+
+    # random augmentations would be frozen into the cache, so images are
+    # center cropped
+    pipeline = [
+        dict(
+            type='torchvision/Resize',
+            size=args.size,
+            interpolation='bilinear'),
+        dict(type='torchvision/CenterCrop', size=args.size),
+        dict(type='torchvision/ToTensor'),
+        dict(type='torchvision/Normalize', mean=[0.5], std=[0.5]),
+        dict(type='PackInputs', input_keys=['img']),
+    ]
+    dataset = HFDataset(
+        dataset=args.dataset,
+        image_column=args.image_column,
+        caption_column=args.caption_column,
+        pipeline=pipeline)
+    vae = AutoencoderKL.from_pretrained(args.sdmodel, subfolder='vae')
+    vae.to(args.device)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for i in tqdm(range(len(dataset))):
+        img = dataset[i]['inputs']['img'][None].to(args.device)
+        # mean and logvar of the latent distribution
+        parameters = vae.encode(img).latent_dist.parameters[0]
+        np.save(osp.join(args.out_dir, f'{i}.npy'), parameters.cpu().numpy())
+
+
+if __name__ == '__main__':
+    main()
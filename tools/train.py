@@ -2,9 +2,11 @@ import argparse
 import os
 import os.path as osp
 
+import torch
 from mmengine.config import Config, DictAction
 from mmengine.registry import RUNNERS
 from mmengine.runner import Runner
+from mmengine.utils import digit_version
 
 
 def parse_args():
@@ -77,8 +79,23 @@ def merge_args(cfg, args):
     return cfg
 
 
+def setup_cuda_allocator():
+    """Let the CUDA caching allocator grow segments in place.
+
+    Alternating training steps with ``infer`` of the visualization hook
+    fragments fixed size segments. Expandable segments keep the reserved
+    memory close to the allocated memory. The allocator reads the option on
+    first use of CUDA, so it must be set before the runner is built. A value
+    set by the user is kept.
+    """
+    if digit_version(torch.__version__) >= digit_version('2.1.0'):
+        os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF',
+                              'expandable_segments:True')
+
+
 def main():
     args = parse_args()
+    setup_cuda_allocator()
 
     # load config
     cfg = Config.fromfile(args.config)